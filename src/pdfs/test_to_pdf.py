@@ -0,0 +1,61 @@
+"""
+Run with: python3 -m unittest discover -s src/pdfs
+"""
+from PIL import Image, PdfParser
+from concurrent.futures import ThreadPoolExecutor
+import os
+import tempfile
+import unittest
+
+import to_pdf
+
+
+def read_media_boxes(path):
+    with PdfParser.PdfParser(path) as pdf:
+        return [list(pdf.read_indirect(page)[b'MediaBox']) for page in pdf.pages]
+
+
+class CreatePdfTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.dir = self.tmp.name
+        Image.new('RGB', (200, 100), (200, 30, 30)).save(os.path.join(self.dir, 'a.jpg'))
+        Image.new('L', (50, 80), 128).save(os.path.join(self.dir, 'b.jpg'))
+        self.out = os.path.join(self.dir, to_pdf.OUT_FILENAME)
+
+    def test_write_pdf_round_trip(self):
+        Image.new('P', (100, 100)).save(os.path.join(self.dir, 'c.png'))
+        paths = to_pdf.get_items(self.dir)
+        with ThreadPoolExecutor() as executor:
+            submit = executor.submit
+            submitted = []
+            executor.submit = lambda fn, path: submitted.append(path) or submit(fn, path)
+            pages = list(to_pdf.read_pages(paths, executor))
+        self.assertEqual(submitted, [paths[2]])
+        with open(paths[0], 'rb') as f:
+            self.assertEqual(pages[0][0], f.read())
+        to_pdf.write_pdf(self.out, pages)
+        self.assertEqual(read_media_boxes(self.out), [[0, 0, 144, 72], [0, 0, 36, 57.6], [0, 0, 72, 72]])
+
+    def test_transformed_pages(self):
+        to_pdf.create_pdf(to_pdf.get_items(self.dir), resize_ratio=0.5, rotate_angle=90)
+        self.assertEqual(read_media_boxes(self.out), [[0, 0, 36, 72], [0, 0, 28.8, 18]])
+
+    def test_failed_page_keeps_previous_result(self):
+        with open(self.out, 'wb') as f:
+            f.write(b'previous')
+        broken = os.path.join(self.dir, 'c.png')
+        Image.new('RGB', (300, 300)).save(broken)
+        with open(broken, 'r+b') as f:
+            f.truncate(os.path.getsize(broken) // 2)
+        with self.assertRaises(OSError):
+            to_pdf.create_pdf(to_pdf.get_items(self.dir))
+        with open(self.out, 'rb') as f:
+            self.assertEqual(f.read(), b'previous')
+        self.assertFalse(os.path.exists(self.out + '.part'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,71 +1,200 @@
 """
 Example of usage: python3 to_pdf --path ~/data/ --resize 0.3
 """
-from PIL import Image
+from PIL import Image, features
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import os
 import time
 import argparse
+import io
+import warnings
 
 IMAGE_PATH = '~/data/'
 OUT_FILENAME = 'Result.pdf'
 RESIZE_RATIO = 1
 ROTATE_ANGLE = 0
+JPEG_EXTENSIONS = ('.jpg', '.jpeg')
+IMAGE_EXTENSIONS = JPEG_EXTENSIONS + ('.png',)
+TRANSPOSITIONS = {90: Image.ROTATE_90, 180: Image.ROTATE_180, 270: Image.ROTATE_270}
+COLOR_SPACES = {'L': b'DeviceGray', 'RGB': b'DeviceRGB'}
+PDF_RESOLUTION = 100.0
+
+
+def check_jpeg_support():
+    try:
+        turbo = features.check_feature('libjpeg_turbo')
+    except ValueError:
+        turbo = None
+    if turbo is False:
+        warnings.warn("Pillow is not built against libjpeg-turbo, JPEG decoding and encoding will be slow. "
+                      "Consider installing pillow-simd or a Pillow build linked with libjpeg-turbo.")
+
+
+def positive_float(value):
+    ratio = float(value)
+    if not 0 < ratio < float('inf'):
+        raise argparse.ArgumentTypeError("must be a finite number greater than 0, got %s" % value)
+    return ratio
 
 
 def get_items(path):
-    items = os.listdir(path)
-    items = [path + i for i in sorted(items)]
-    items = [i for i in items if os.path.isfile(i)]
-    items = [i for i in items if i.endswith('.jpg') or i.endswith('.png')]
+    with os.scandir(path) as entries:
+        items = sorted(e.path for e in entries if e.is_file() and e.name.lower().endswith(IMAGE_EXTENSIONS))
     print("Found images:", items, "\n")
     return items
 
 
-def resize(image, resize_ratio):
-    if resize_ratio != 1:
-        image = image.resize((int(image.size[0]*resize_ratio), int(image.size[1]*resize_ratio)), Image.ANTIALIAS)
+def scaled_size(size, resize_ratio):
+    return max(1, int(size[0]*resize_ratio)), max(1, int(size[1]*resize_ratio))
+
+
+def resize(image, size):
+    if image.size != size:
+        # reducing_gap lets Pillow box-reduce by an integer factor first and run Lanczos only on the rest
+        reducing_gap = 3.0 if size[0] * 3 < image.size[0] else 2.0
+        image = image.resize(size, Image.LANCZOS, reducing_gap=reducing_gap)
     return image
 
 
 def rotate(image, rotate_angle):
-    if rotate_angle != 0:
+    rotate_angle %= 360
+    if rotate_angle in TRANSPOSITIONS:
+        image = image.transpose(TRANSPOSITIONS[rotate_angle])
+    elif rotate_angle != 0:
         image = image.rotate(rotate_angle, expand=True)
     return image
 
 
+def open_file(path):
+    f = open(path, 'rb')
+    if hasattr(os, 'posix_fadvise'):
+        # the whole file is read front to back, let the kernel read ahead
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    return f
+
+
+def prepare(source, resize_ratio, rotate_angle):
+    size = scaled_size(source.size, resize_ratio)
+    if resize_ratio < 1:
+        # let libjpeg scale down in the DCT domain while decoding, no-op for other formats
+        source.draft('RGB', size)
+    image = resize(source.convert('RGB'), size)
+    return rotate(image, rotate_angle)
+
+
+def embeddable_jpeg(path):
+    """Return (width, height, color_space) of a JPEG that can be embedded as-is, None otherwise."""
+    with open_file(path) as f, Image.open(f) as source:
+        if source.format == 'JPEG' and source.mode in COLOR_SPACES:
+            return source.width, source.height, COLOR_SPACES[source.mode]
+    return None
+
+
+def page_data(path, resize_ratio, rotate_angle):
+    """Return (jpeg_bytes, width, height, color_space) of a page decoded and re-encoded as RGB JPEG."""
+    buffer = io.BytesIO()
+    with open_file(path) as f, Image.open(f) as source, prepare(source, resize_ratio, rotate_angle) as image:
+        image.save(buffer, 'JPEG')
+        width, height = image.size
+    return buffer.getvalue(), width, height, COLOR_SPACES['RGB']
+
+
+def read_pages(image_paths, executor, resize_ratio=RESIZE_RATIO, rotate_angle=ROTATE_ANGLE):
+    """Yield page data in input order, copying untouched JPEGs and decoding the rest in the executor."""
+    to_page = partial(page_data, resize_ratio=resize_ratio, rotate_angle=rotate_angle)
+    untouched = resize_ratio == 1 and rotate_angle % 360 == 0
+    # headers are cheap to parse here, so only pages that need decoding are sent to the workers,
+    # a pass-through page would otherwise be pickled through the single result pipe for nothing
+    jobs = []
+    for path in image_paths:
+        jpeg = embeddable_jpeg(path) if untouched else None
+        jobs.append((path, jpeg, None if jpeg else executor.submit(to_page, path)))
+    if any(future is not None for _, _, future in jobs):
+        check_jpeg_support()
+    for path, jpeg, future in jobs:
+        if future is None:
+            with open_file(path) as f:
+                yield (f.read(),) + jpeg
+        else:
+            yield future.result()
+
+
+def write_object(f, offsets, number, body, stream=None):
+    offsets[number] = f.tell()
+    f.write(b'%d 0 obj\n' % number)
+    f.write(body)
+    if stream is not None:
+        f.write(b'\nstream\n')
+        f.write(stream)
+        f.write(b'\nendstream')
+    f.write(b'\nendobj\n')
+
+
+def write_pdf(out, pages, resolution=PDF_RESOLUTION):
+    """Write pages given as (jpeg_bytes, width, height, color_space) as a PDF with one image per page."""
+    catalog, page_tree = 1, 2
+    offsets = {}
+    kids = []
+    # write next to the target and only replace it once the trailer is written, so a failing page
+    # never leaves a truncated PDF behind or clobbers a previous result
+    partial_out = out + '.part'
+    with open(partial_out, 'wb') as f:
+        try:
+            f.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+            for data, width, height, color_space in pages:
+                image = 3 + 3 * len(kids)
+                content, page = image + 1, image + 2
+                write_object(f, offsets, image,
+                             b'<< /Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace /%s '
+                             b'/BitsPerComponent 8 /Filter /DCTDecode /Length %d >>'
+                             % (width, height, color_space, len(data)), data)
+                page_width, page_height = width * 72 / resolution, height * 72 / resolution
+                drawing = b'q %g 0 0 %g 0 0 cm /Im0 Do Q' % (page_width, page_height)
+                write_object(f, offsets, content, b'<< /Length %d >>' % len(drawing), drawing)
+                write_object(f, offsets, page,
+                             b'<< /Type /Page /Parent %d 0 R /MediaBox [0 0 %g %g] '
+                             b'/Resources << /XObject << /Im0 %d 0 R >> >> /Contents %d 0 R >>'
+                             % (page_tree, page_width, page_height, image, content))
+                kids.append(page)
+            # the page tree and catalog go last, once every page object number is known
+            write_object(f, offsets, page_tree, b'<< /Type /Pages /Kids [%s] /Count %d >>'
+                         % (b' '.join(b'%d 0 R' % kid for kid in kids), len(kids)))
+            write_object(f, offsets, catalog, b'<< /Type /Catalog /Pages %d 0 R >>' % page_tree)
+            xref = f.tell()
+            f.write(b'xref\n0 %d\n0000000000 65535 f \n' % (len(offsets) + 1))
+            for number in range(1, len(offsets) + 1):
+                f.write(b'%010d 00000 n \n' % offsets[number])
+            f.write(b'trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n'
+                    % (len(offsets) + 1, catalog, xref))
+        except BaseException:
+            f.close()
+            os.remove(partial_out)
+            raise
+    os.replace(partial_out, out)
+
+
 def create_pdf(image_paths, out_filename=OUT_FILENAME, resize_ratio=RESIZE_RATIO, rotate_angle=ROTATE_ANGLE):
     if not image_paths:
         print("No image paths found.")
         return
 
-    images = [Image.open(i) for i in image_paths]
+    out = os.path.split(image_paths[0])[0] + "/" + out_filename
+    print("Converting and saving...", out)
     t1 = time.perf_counter()
-    print("Conversion...")
-    images = [i.convert('RGB') for i in images]
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        write_pdf(out, read_pages(image_paths, executor, resize_ratio, rotate_angle))
     t2 = time.perf_counter()
     print("... Took:", t2 - t1)
-    print("Resizing...")
-    images = [resize(i, resize_ratio) for i in images]
-    images = [rotate(i, rotate_angle) for i in images]
-    out = os.path.split(image_paths[0])[0] + "/" + out_filename
-    print("Saving...", out)
-    images[0].save(
-        out,
-        'PDF',
-        resolution=100.00,
-        save_all=True,
-        append_images=images[1:]
-    )
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Convert set of images to single PDF")
-    parser.add_argument("--path", help="path to images to be converted, default: ~/data/")
-    parser.add_argument("--resize", help="resize image ratio, default: 1, no resize", type=float)
-    parser.add_argument("--rotate", help="rotate image (in degrees), default: 0, no rotation", type=int)
+    parser.add_argument("--path", help="path to images to be converted, default: ~/data/", default=IMAGE_PATH)
+    parser.add_argument("--resize", help="resize image ratio, default: 1, no resize", type=positive_float,
+                        default=RESIZE_RATIO)
+    parser.add_argument("--rotate", help="rotate image (in degrees), default: 0, no rotation", type=int,
+                        default=ROTATE_ANGLE)
     args = parser.parse_args()
-    path_to_imgs = args.path and args.path or IMAGE_PATH
-    resize_ratio = args.resize and args.resize or RESIZE_RATIO
-    rotate_angle = args.rotate and args.rotate or ROTATE_ANGLE
-    items = get_items(path_to_imgs)
-    create_pdf(items, OUT_FILENAME, resize_ratio, rotate_angle)
+    items = get_items(os.path.expanduser(args.path))
+    create_pdf(items, OUT_FILENAME, args.resize, args.rotate)